@@ -1,15 +1,41 @@
 """PostgreSQL database utilities for ingestion scripts."""
 
+import io
 from contextlib import contextmanager
 from datetime import date
-from typing import Optional
+from functools import lru_cache
+from typing import NamedTuple, Optional
 
-from sqlalchemy import create_engine, text
+import psycopg2
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 
 from app.config import settings
 
-engine = create_engine(settings.database_url, pool_pre_ping=True)
+# Per-connection settings for the write-heavy ingestion workload:
+# - synchronous_commit: ingestion is re-runnable from Yahoo, so trade commit
+#   durability for fewer WAL flushes (a crash can lose the last commit, never corrupt)
+# - temp_buffers: keep the price_history_staging temp table in memory
+# - maintenance_work_mem: faster index rebuilds after bulk loads
+SESSION_SETTINGS = {
+    "synchronous_commit": "off",
+    "temp_buffers": "64MB",
+    "maintenance_work_mem": "256MB",
+}
+
+# psycopg2's cursor.executemany sends one statement per row; values_plus_batch makes
+# SQLAlchemy use execute_batch instead, packing up to a page of statements per round trip.
+# The page matches the chunks() default used for the fallback price batches.
+EXECUTEMANY_PAGE_SIZE = 500
+
+engine = create_engine(
+    settings.database_url,
+    pool_pre_ping=True,
+    executemany_mode="values_plus_batch",
+    executemany_batch_page_size=EXECUTEMANY_PAGE_SIZE,
+    connect_args={"options": " ".join(f"-c {k}={v}" for k, v in SESSION_SETTINGS.items())},
+)
 SessionLocal = sessionmaker(bind=engine)
 
 
@@ -26,87 +52,275 @@ def get_session():
         session.close()
 
 
-def get_or_create_asset(session, symbol: str, name: str, asset_type: str, currency: str,
-                        yahoo_symbol: Optional[str] = None) -> int:
-    """Return asset id, inserting if missing."""
-    row = session.execute(
-        text("SELECT id FROM assets WHERE symbol = :s"), {"s": symbol.upper()}
-    ).fetchone()
-
-    if row:
-        session.execute(
-            text("UPDATE assets SET name = :n, currency = :c, yahoo_symbol = COALESCE(:y, yahoo_symbol) WHERE symbol = :s"),
-            {"n": name, "c": currency, "y": yahoo_symbol, "s": symbol.upper()},
-        )
-        return row[0]
-
-    result = session.execute(
-        text(
-            "INSERT INTO assets (symbol, name, asset_type, currency, yahoo_symbol) "
-            "VALUES (:s, :n, :t, :c, :y) RETURNING id"
-        ),
-        {"s": symbol.upper(), "n": name, "t": asset_type, "c": currency, "y": yahoo_symbol},
+# Secondary price_history indexes that a bulk load can rebuild afterwards. The
+# uq_price_asset_date constraint stays: ON CONFLICT (asset_id, date) depends on it.
+DEFERRABLE_PRICE_INDEXES = {
+    "ix_price_history_asset_id": "CREATE INDEX IF NOT EXISTS ix_price_history_asset_id ON price_history (asset_id)",
+    "ix_price_history_date": "CREATE INDEX IF NOT EXISTS ix_price_history_date ON price_history (date)",
+}
+
+
+@contextmanager
+def deferred_price_indexes():
+    """Drop secondary price_history indexes for the duration of a bulk load, then rebuild + ANALYZE.
+
+    Drop and rebuild run in their own short transactions so the exclusive lock they
+    take is not held for the whole ingestion run.
+    """
+    with get_session() as session:
+        for name in DEFERRABLE_PRICE_INDEXES:
+            session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    try:
+        yield
+    finally:
+        with get_session() as session:
+            for ddl in DEFERRABLE_PRICE_INDEXES.values():
+                session.execute(text(ddl))
+            session.execute(text("ANALYZE price_history"))
+
+
+def restore_price_indexes() -> list[str]:
+    """Recreate deferrable price_history indexes left dropped by an interrupted bulk load.
+
+    A kill between deferred_price_indexes' drop and its rebuild would otherwise leave them
+    missing for good, since later runs see a non-empty table and never take the bulk path.
+    Returns the names of the indexes it had to create.
+    """
+    with get_session() as session:
+        existing = set(session.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = 'price_history'")
+        ).scalars())
+        missing = [name for name in DEFERRABLE_PRICE_INDEXES if name not in existing]
+        for name in missing:
+            session.execute(text(DEFERRABLE_PRICE_INDEXES[name]))
+    return missing
+
+
+class AssetRow(NamedTuple):
+    id: int
+    name: Optional[str]
+    currency: Optional[str]
+    yahoo_symbol: Optional[str]
+
+
+_ASSET_ROW_COLUMNS = "id, name, currency, yahoo_symbol"
+
+
+def get_assets(session) -> dict[str, AssetRow]:
+    """Return {symbol: AssetRow} for every asset, to preload get_or_create_asset's cache."""
+    rows = session.execute(text(f"SELECT symbol, {_ASSET_ROW_COLUMNS} FROM assets")).fetchall()
+    return {symbol: AssetRow(*rest) for symbol, *rest in rows}
+
+
+# Runs for new assets and for cached ones whose metadata differs from what was just
+# fetched. The WHERE still skips the write when the row already matches (the cache was
+# stale, or there is no cache); a skipped update returns nothing from the CTE, so fall
+# back to reading the row directly. A NULL :n keeps the stored name (new assets are
+# named after their symbol).
+UPSERT_ASSET_SQL = text(f"""
+    WITH upserted AS (
+        INSERT INTO assets (symbol, name, asset_type, currency, yahoo_symbol)
+        VALUES (:s, COALESCE(:n, :s), :t, :c, :y)
+        ON CONFLICT (symbol) DO UPDATE SET
+            name = COALESCE(:n, assets.name),
+            currency = EXCLUDED.currency,
+            yahoo_symbol = COALESCE(EXCLUDED.yahoo_symbol, assets.yahoo_symbol)
+        WHERE (assets.name, assets.currency, assets.yahoo_symbol)
+            IS DISTINCT FROM (COALESCE(:n, assets.name), EXCLUDED.currency,
+                              COALESCE(EXCLUDED.yahoo_symbol, assets.yahoo_symbol))
+        RETURNING {_ASSET_ROW_COLUMNS}
     )
-    return result.fetchone()[0]
+    SELECT {_ASSET_ROW_COLUMNS} FROM upserted
+    UNION ALL
+    SELECT {_ASSET_ROW_COLUMNS} FROM assets WHERE symbol = :s
+    LIMIT 1
+""")
 
 
-def get_tracked_assets(session) -> list[dict]:
-    """Return all tracked assets for DB-driven ingestion."""
-    rows = session.execute(
-        text("SELECT symbol, yahoo_symbol, asset_type, currency FROM assets WHERE tracked = true")
-    ).fetchall()
-    return [{"symbol": r[0], "yahoo_symbol": r[1], "asset_type": r[2], "currency": r[3]} for r in rows]
+def get_or_create_asset(session, symbol: str, name: Optional[str], asset_type: str, currency: str,
+                        yahoo_symbol: Optional[str] = None, cache: Optional[dict] = None) -> int:
+    """Return asset id, inserting if missing and refreshing name, currency and yahoo_symbol.
+
+    A None name or yahoo_symbol keeps the stored value. Assets in cache whose metadata
+    already matches are returned without touching the DB; written rows update the cache.
+    """
+    symbol = symbol.upper()
+    cached = cache.get(symbol) if cache is not None else None
+    if cached is not None and (name is None or name == cached.name) and currency == cached.currency \
+            and (yahoo_symbol is None or yahoo_symbol == cached.yahoo_symbol):
+        return cached.id
+
+    row = AssetRow(*session.execute(
+        UPSERT_ASSET_SQL,
+        {"s": symbol, "n": name, "t": asset_type, "c": currency, "y": yahoo_symbol},
+    ).one())
 
+    if cache is not None:
+        cache[symbol] = row
+    return row.id
 
-def upsert_price(session, asset_id: int, price_date: date, open_: Optional[float] = None,
-                 high: Optional[float] = None, low: Optional[float] = None, close: Optional[float] = None, volume: Optional[int] = None):
+
+def create_assets(session, rows: list[dict], cache: dict):
+    """Insert the assets in rows that cache doesn't have yet, in one batch, and cache them.
+
+    rows carry symbol, name, asset_type, currency and yahoo_symbol.
+    """
+    rows = [r for r in rows if r["symbol"] not in cache]
+    if not rows:
+        return
     session.execute(
         text("""
-            INSERT INTO price_history (asset_id, date, open, high, low, close, volume)
-            VALUES (:aid, :d, :o, :h, :l, :c, :v)
-            ON CONFLICT (asset_id, date) DO UPDATE SET
-                open = EXCLUDED.open,
-                high = EXCLUDED.high,
-                low = EXCLUDED.low,
-                close = EXCLUDED.close,
-                volume = EXCLUDED.volume
+            INSERT INTO assets (symbol, name, asset_type, currency, yahoo_symbol)
+            VALUES (:symbol, :name, :asset_type, :currency, :yahoo_symbol)
+            ON CONFLICT (symbol) DO NOTHING
         """),
-        {"aid": asset_id, "d": price_date, "o": open_, "h": high, "l": low, "c": close, "v": volume},
+        rows,
     )
+    created = session.execute(
+        text(f"SELECT symbol, {_ASSET_ROW_COLUMNS} FROM assets WHERE symbol IN :symbols").bindparams(
+            bindparam("symbols", expanding=True)
+        ),
+        {"symbols": [r["symbol"] for r in rows]},
+    ).fetchall()
+    cache.update({symbol: AssetRow(*rest) for symbol, *rest in created})
+
+
+def get_latest_price_dates(session) -> dict[int, date]:
+    """Return {asset_id: latest stored price date} in a single grouped query."""
+    return dict(session.execute(
+        text("SELECT asset_id, MAX(date) FROM price_history GROUP BY asset_id")
+    ).fetchall())
 
 
-def upsert_fundamentals(session, asset_id: int, today: date, metrics: dict):
-    fields = list(metrics.keys())
-    set_clause = ", ".join(f"{f} = EXCLUDED.{f}" for f in fields)
+def price_history_is_empty(session) -> bool:
+    return session.execute(text("SELECT NOT EXISTS (SELECT 1 FROM price_history)")).scalar_one()
+
+
+def get_tracked_symbols(session) -> list[str]:
+    """Return the Yahoo symbol of every tracked asset, for DB-driven ingestion."""
+    return session.execute(
+        text("SELECT COALESCE(yahoo_symbol, symbol) FROM assets WHERE tracked = true")
+    ).scalars().all()
+
+
+# Built once at import so the hot upsert paths reuse the same statement objects
+# (SQLAlchemy caches their compiled form) instead of re-parsing SQL per call.
+_PRICE_COLUMNS = "asset_id, date, open, high, low, close, volume"
+# Re-runs mostly resend bars that are already stored; the WHERE skips those so only
+# changed rows are rewritten (no dead tuple, index churn or WAL for unchanged ones).
+_PRICE_ON_CONFLICT = """
+    ON CONFLICT (asset_id, date) DO UPDATE SET
+        open = EXCLUDED.open,
+        high = EXCLUDED.high,
+        low = EXCLUDED.low,
+        close = EXCLUDED.close,
+        volume = EXCLUDED.volume
+    WHERE (price_history.open, price_history.high, price_history.low,
+           price_history.close, price_history.volume)
+        IS DISTINCT FROM (EXCLUDED.open, EXCLUDED.high, EXCLUDED.low,
+                          EXCLUDED.close, EXCLUDED.volume)
+"""
+
+UPSERT_PRICE_SQL = text(f"""
+    INSERT INTO price_history ({_PRICE_COLUMNS})
+    VALUES (:asset_id, :date, :open, :high, :low, :close, :volume)
+    {_PRICE_ON_CONFLICT}
+""")
+
+CREATE_PRICE_STAGING_SQL = text("""
+    CREATE TEMP TABLE IF NOT EXISTS price_history_staging (
+        asset_id INTEGER, date DATE, open DOUBLE PRECISION, high DOUBLE PRECISION,
+        low DOUBLE PRECISION, close DOUBLE PRECISION, volume BIGINT
+    ) ON COMMIT DROP
+""")
+
+# Raw psycopg2 COPY; unquoted empty CSV fields (NaN / <NA> from to_csv) load as NULL
+COPY_PRICE_STAGING_SQL = f"COPY price_history_staging ({_PRICE_COLUMNS}) FROM STDIN WITH (FORMAT csv)"
+
+MERGE_PRICE_STAGING_SQL = text(f"""
+    INSERT INTO price_history ({_PRICE_COLUMNS})
+    SELECT {_PRICE_COLUMNS} FROM price_history_staging
+    {_PRICE_ON_CONFLICT}
+""")
+
+CLEAR_PRICE_STAGING_SQL = text("DELETE FROM price_history_staging")
+
+
+def upsert_prices(session, rows: list[dict]):
+    """Upsert many price rows in one executemany call (keys are price_history column names)."""
+    if rows:
+        session.execute(UPSERT_PRICE_SQL, rows)
+
+
+def upsert_prices_staged(session, frame):
+    """Bulk upsert a frame whose columns match price_history (asset_id, date, open ... volume).
+
+    The frame is streamed into a temp staging table with COPY, then merged into
+    price_history with a single INSERT ... SELECT ... ON CONFLICT.
+    """
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    session.execute(CREATE_PRICE_STAGING_SQL)
+    with session.connection().connection.cursor() as cursor:
+        try:
+            cursor.copy_expert(COPY_PRICE_STAGING_SQL, buf)
+        except psycopg2.Error as e:
+            # Raw cursor errors bypass SQLAlchemy; wrap them so callers see the usual exception types
+            raise DBAPIError.instance(COPY_PRICE_STAGING_SQL, None, e, psycopg2.Error) from e
+    session.execute(MERGE_PRICE_STAGING_SQL)
+    session.execute(CLEAR_PRICE_STAGING_SQL)
+
+
+@lru_cache(maxsize=None)
+def _fundamentals_sql(fields: tuple[str, ...]):
+    """Build the fundamentals upsert; NULLs never overwrite stored values."""
+    set_clause = ", ".join(f"{f} = COALESCE(EXCLUDED.{f}, fundamentals.{f})" for f in fields)
     columns = "asset_id, date, " + ", ".join(fields)
     placeholders = ":asset_id, :today, " + ", ".join(f":{f}" for f in fields)
+    return text(f"""
+        INSERT INTO fundamentals ({columns})
+        VALUES ({placeholders})
+        ON CONFLICT (asset_id, date) DO UPDATE SET {set_clause}
+""")
 
-    params = {"asset_id": asset_id, "today": today, **metrics}
-    session.execute(
-        text(f"""
-            INSERT INTO fundamentals ({columns})
-            VALUES ({placeholders})
-            ON CONFLICT (asset_id, date) DO UPDATE SET {set_clause}
-        """),
-        params,
-    )
 
+def upsert_fundamentals(session, fields: list[str], rows: list[dict]):
+    """Upsert daily fundamentals snapshots for many assets in one executemany.
 
-def upsert_financials(session, table: str, asset_id: int, record_date: date,
-                      period_type: str, data: dict):
-    fields = list(data.keys())
-    if not fields:
-        return
-    set_clause = ", ".join(f"{f} = EXCLUDED.{f}" for f in fields)
+    Sent as one round trip per EXECUTEMANY_PAGE_SIZE rows (values_plus_batch engine).
+    Each row has asset_id, today and a value (or None) for every column in fields.
+    """
+    if fields and rows:
+        session.execute(_fundamentals_sql(tuple(fields)), rows)
+
+
+@lru_cache(maxsize=None)
+def _financials_sql(table: str, fields: tuple[str, ...]):
+    """Build the upsert for one statement table.
+
+    NULLs never overwrite stored values, and rows whose values are unchanged are not rewritten.
+    """
+    merged = {f: f"COALESCE(EXCLUDED.{f}, {table}.{f})" for f in fields}
+    set_clause = ", ".join(f"{f} = {expr}" for f, expr in merged.items())
     columns = "asset_id, date, period_type, " + ", ".join(fields)
     placeholders = ":asset_id, :d, :pt, " + ", ".join(f":{f}" for f in fields)
+    current = ", ".join(f"{table}.{f}" for f in fields)
+    return text(f"""
+        INSERT INTO {table} ({columns})
+        VALUES ({placeholders})
+        ON CONFLICT (asset_id, date, period_type) DO UPDATE SET {set_clause}
+        WHERE ({current}) IS DISTINCT FROM ({", ".join(merged.values())})
+    """)
 
-    params = {"asset_id": asset_id, "d": record_date, "pt": period_type, **data}
-    session.execute(
-        text(f"""
-            INSERT INTO {table} ({columns})
-            VALUES ({placeholders})
-            ON CONFLICT (asset_id, date, period_type) DO UPDATE SET {set_clause}
-        """),
-        params,
-    )
+
+def upsert_financials(session, table: str, fields: list[str], rows: list[dict]):
+    """Upsert statement rows in one executemany.
+
+    The engine's values_plus_batch mode sends the rows as one round trip per
+    EXECUTEMANY_PAGE_SIZE rows, so a statement's dates go out together. Each row has
+    asset_id, d, pt and a value (or None) for every column in fields.
+    """
+    if fields and rows:
+        session.execute(_financials_sql(table, tuple(fields)), rows)
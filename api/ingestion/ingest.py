@@ -2,12 +2,37 @@
 """Data ingestion CLI — all tracked assets."""
 
 import argparse
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
 
-import yfinance as yf
+from sqlalchemy.exc import SQLAlchemyError
 
-from ingestion.db import get_session, get_or_create_asset, get_tracked_assets, upsert_fundamentals
-from ingestion.utils import safe_float, store_prices, store_financial_df, run_loop
+from app.config import settings
+from ingestion.db import (
+    create_assets, deferred_price_indexes, get_assets, get_session, get_latest_price_dates,
+    get_or_create_asset, get_tracked_symbols, price_history_is_empty, restore_price_indexes,
+    upsert_fundamentals,
+)
+from ingestion.utils import (
+    FetchPool, chunks, configure_logging, run_loop, safe_float, store_prices, store_financial_df,
+)
+
+if TYPE_CHECKING:
+    import yfinance as yf
+
+logger = logging.getLogger(__name__)
+
+# Minimum date span for a full load to count as a backfill (see deferred_price_indexes)
+BULK_LOAD_DAYS = 365
+# Symbols per yf.download request; Yahoo serves up to 20 per call
+DOWNLOAD_BATCH = 20
+# Symbols stored per transaction; bounds the work lost to a crash or Ctrl+C mid-run
+COMMIT_EVERY = 25
 
 FUNDAMENTALS_MAPPING = {
     "market_cap": "marketCap",
@@ -102,79 +127,325 @@ CF_MAPPING = {
 }
 
 
-def fetch_asset(yahoo_symbol: str, start_date: str, end_date: str) -> int:
-    is_idx = yahoo_symbol.endswith(".JK")
-    ticker = yf.Ticker(yahoo_symbol)
+FINANCIAL_STATEMENTS = [
+    ("financials", "annual", "financials_income", INCOME_MAPPING),
+    ("balance_sheet", "annual", "financials_balance", BALANCE_MAPPING),
+    ("cashflow", "annual", "financials_cashflow", CF_MAPPING),
+    ("quarterly_financials", "quarterly", "financials_income", INCOME_MAPPING),
+    ("quarterly_balance_sheet", "quarterly", "financials_balance", BALANCE_MAPPING),
+    ("quarterly_cashflow", "quarterly", "financials_cashflow", CF_MAPPING),
+]
 
-    try:
-        df = ticker.history(start=start_date, end=end_date)
-    except Exception as e:
-        print(f"    Error fetching {yahoo_symbol}: {e}")
-        return 0
+
+@lru_cache(maxsize=None)
+def load_yfinance():
+    """Import yfinance on first use; it is the slowest import here and --help doesn't need it."""
+    import yfinance as yf
+
+    # yfinance persists each symbol's exchange timezone and the Yahoo cookie in an on-disk
+    # cache; a stable location lets repeat runs skip those lookups instead of redoing them
+    # in every fresh container.
+    if settings.yfinance_cache_dir:
+        yf.set_tz_cache_location(settings.yfinance_cache_dir)
+    return yf
+
+
+_ticker_cache: dict[str, "yf.Ticker"] = {}
+
+
+def get_ticker(yahoo_symbol: str) -> "yf.Ticker":
+    """Return a process-wide yf.Ticker so repeated lookups share its cached responses."""
+    ticker = _ticker_cache.get(yahoo_symbol)
+    if ticker is None:
+        ticker = _ticker_cache[yahoo_symbol] = load_yfinance().Ticker(yahoo_symbol)
+    return ticker
+
+
+def download_prices(symbols: list[str], start_date: str, end_date: str) -> dict:
+    """Fetch price history for many symbols, DOWNLOAD_BATCH per yf.download call, keyed by symbol.
+
+    Symbols missing from the result (failed batch or empty history) are fetched individually.
+    """
+    prices = {}
+    for batch in chunks(symbols, DOWNLOAD_BATCH):
+        try:
+            data = load_yfinance().download(batch, start=start_date, end=end_date, group_by="ticker",
+                                           auto_adjust=True, threads=True, progress=False)
+        except Exception as e:
+            logger.warning(f"Bulk download failed for {len(batch)} symbols, falling back to per-symbol fetch: {e}")
+            continue
+
+        for symbol in batch:
+            try:
+                df = data[symbol].dropna(how="all")
+            except KeyError:
+                continue
+            if not df.empty:
+                prices[symbol] = df
+    return prices
+
+
+def fetch_asset(yahoo_symbol: str, start_date: str, end_date: str, df=None) -> Optional[dict]:
+    """Download everything needed for one asset. Network only — safe to run in worker threads.
+
+    df is the symbol's slice of a bulk download; history is fetched individually when missing.
+    """
+    ticker = get_ticker(yahoo_symbol)
+
+    if df is None:
+        try:
+            df = ticker.history(start=start_date, end=end_date)
+        except Exception as e:
+            logger.error(f"    Error fetching {yahoo_symbol}: {e}")
+            return None
 
     if df.empty:
-        print(f"    No data for {yahoo_symbol}")
+        logger.warning(f"    No data for {yahoo_symbol}")
+        return None
+
+    data = {"prices": df, "info": {}, "statements": {}}
+    if not yahoo_symbol.endswith(".JK"):
+        return data
+
+    try:
+        data["info"] = ticker.info
+    except Exception:
+        pass
+
+    # Each statement is its own request; keep the ones that succeed if another fails
+    for attr, *_ in FINANCIAL_STATEMENTS:
+        try:
+            data["statements"][attr] = getattr(ticker, attr)
+        except Exception as e:
+            logger.warning(f"    Financials error for {yahoo_symbol} ({attr}): {e}")
+
+    return data
+
+
+def store_asset(session, yahoo_symbol: str, data: Optional[dict], assets: Optional[dict] = None,
+                fundamentals: Optional[list] = None) -> int:
+    """Write the result of fetch_asset. DB only — must run on the session's thread.
+
+    assets is the {symbol: AssetRow} cache passed through to get_or_create_asset. When
+    fundamentals is a list, the snapshot row is queued on it for store_fundamentals
+    instead of being written immediately.
+    """
+    if data is None:
         return 0
 
-    with get_session() as session:
-        if is_idx:
-            symbol = yahoo_symbol.removesuffix(".JK")
-            try:
-                info = ticker.info
-                name = info.get("longName") or info.get("shortName") or symbol
-            except Exception:
-                info, name = {}, symbol
+    df = data["prices"]
+    key = yahoo_symbol.removesuffix(".JK").upper()
+    cached = assets.get(key) if assets is not None else None
+    snapshot = None
+
+    # Savepoint per symbol: a failure rolls back only this asset, not the run
+    try:
+        with session.begin_nested():
+            if yahoo_symbol.endswith(".JK"):
+                symbol = yahoo_symbol.removesuffix(".JK")
+                info = data["info"]
+                # None when info failed: keeps a stored name instead of reverting it to the symbol
+                name = info.get("longName") or info.get("shortName")
 
-            asset_id = get_or_create_asset(session, symbol, name, "stock", "IDR", yahoo_symbol=yahoo_symbol)
-            count = store_prices(session, asset_id, df, precision=4)
+                asset_id = get_or_create_asset(session, symbol, name, "stock", "IDR",
+                                               yahoo_symbol=yahoo_symbol, cache=assets)
+                count = store_prices(session, asset_id, df, precision=4)
 
-            try:
-                clean = {k: safe_float(info.get(yf_key)) for k, yf_key in FUNDAMENTALS_MAPPING.items()
-                         if info.get(yf_key) is not None}
-                if clean:
-                    upsert_fundamentals(session, asset_id, date.today(), clean)
-            except Exception as e:
-                print(f"    Fundamentals error: {e}")
+                clean = {k: safe_float(info.get(yf_key)) for k, yf_key in FUNDAMENTALS_MAPPING.items()}
+                if any(v is not None for v in clean.values()):
+                    snapshot = {"asset_id": asset_id, "today": date.today(), **clean}
 
-            try:
-                store_financial_df(session, asset_id, ticker.financials, "annual", "financials_income", INCOME_MAPPING)
-                store_financial_df(session, asset_id, ticker.balance_sheet, "annual", "financials_balance", BALANCE_MAPPING)
-                store_financial_df(session, asset_id, ticker.cashflow, "annual", "financials_cashflow", CF_MAPPING)
-                store_financial_df(session, asset_id, ticker.quarterly_financials, "quarterly", "financials_income", INCOME_MAPPING)
-                store_financial_df(session, asset_id, ticker.quarterly_balance_sheet, "quarterly", "financials_balance", BALANCE_MAPPING)
-                store_financial_df(session, asset_id, ticker.quarterly_cashflow, "quarterly", "financials_cashflow", CF_MAPPING)
-            except Exception as e:
-                print(f"    Financials error: {e}")
-        else:
-            asset_id = get_or_create_asset(
-                session, yahoo_symbol, yahoo_symbol, "unknown", "USD", yahoo_symbol=yahoo_symbol
-            )
-            count = store_prices(session, asset_id, df, precision=6)
+                try:
+                    with session.begin_nested():
+                        for attr, period_type, table, mapping in FINANCIAL_STATEMENTS:
+                            if attr in data["statements"]:
+                                store_financial_df(session, asset_id, data["statements"][attr],
+                                                   period_type, table, mapping)
+                except Exception as e:
+                    logger.warning(f"    Financials error: {e}")
+            else:
+                asset_id = get_or_create_asset(
+                    session, yahoo_symbol, None, "unknown", "USD", yahoo_symbol=yahoo_symbol, cache=assets
+                )
+                count = store_prices(session, asset_id, df, precision=6)
+    except BaseException:
+        # The savepoint may have created or updated this asset; don't leave the cache
+        # pointing at a rolled-back row or metadata
+        if assets is not None:
+            if cached is None:
+                assets.pop(key, None)
+            else:
+                assets[key] = cached
+        raise
 
+    # Queued only after the savepoint committed, so it never references a rolled-back asset
+    if snapshot is not None:
+        if fundamentals is not None:
+            fundamentals.append(snapshot)
+        else:
+            store_fundamentals(session, [snapshot])
     return count
 
 
-def run_all(start_date: str, end_date: str, symbols: list[str] = None,
-            delay: float = 0.5) -> bool:
-    if not symbols:
-        with get_session() as session:
-            assets = get_tracked_assets(session)
+def store_fundamentals(session, rows: list[dict]):
+    """Upsert queued fundamentals rows in one batch.
 
-        if not assets:
-            print("No tracked assets in DB. Add assets manually via API.")
-            return True
+    If the batch fails it is retried row by row, so one bad snapshot doesn't lose the rest.
+    """
+    fields = list(FUNDAMENTALS_MAPPING)
+    try:
+        with session.begin_nested():
+            upsert_fundamentals(session, fields, rows)
+        return
+    except SQLAlchemyError as e:
+        logger.warning(f"    Fundamentals batch failed ({e.__class__.__name__}), retrying per asset")
+
+    for row in rows:
+        try:
+            with session.begin_nested():
+                upsert_fundamentals(session, fields, [row])
+        except SQLAlchemyError as e:
+            logger.warning(f"    Fundamentals error for asset {row['asset_id']}: {e}")
+
+
+def run_all(start_date: str, end_date: str, symbols: list[str] = None,
+            delay: float = 0.5, workers: int = 8, incremental: bool = False,
+            bulk: Optional[bool] = None) -> bool:
+    """Ingest symbols, or every tracked asset when none are given.
 
-        symbols = [a["yahoo_symbol"] or a["symbol"] for a in assets]
+    bulk forces (True) or prevents (False) deferring the price_history indexes; by
+    default they are only deferred for a first full load (see below).
+    """
+    tracked = not symbols
+    if tracked:
+        with get_session() as session:
+            symbols = get_tracked_symbols(session)
 
+    # Repeated --symbols (or assets tracked under a shared yahoo_symbol) would be fetched twice
+    symbols = list(dict.fromkeys(symbols))
     if not symbols:
-        print("No tracked assets in DB. Add assets manually via API.")
+        logger.info("No tracked assets in DB. Add assets manually via API.")
         return True
 
-    print("=" * 60)
-    print("Asset Data Ingestion → PostgreSQL")
-    print(f"Date Range: {start_date} to {end_date}  |  Assets: {len(symbols)}")
-    print("=" * 60)
-    return run_loop(symbols, lambda s: fetch_asset(s, start_date, end_date), delay)
+    logger.info("=" * 60)
+    logger.info("Asset Data Ingestion → PostgreSQL")
+    logger.info(f"Date Range: {start_date} to {end_date}  |  Assets: {len(symbols)}")
+    logger.info("=" * 60)
+
+    # Dropping and rebuilding the table-wide indexes only pays off when most of
+    # price_history is about to be written: a multi-year load of every tracked asset into
+    # an empty table. --symbols subsets, re-runs (mostly unchanged rows) and incremental
+    # runs (each asset resumes from its latest bar, whatever the start date) keep them live.
+    if bulk is None:
+        span = datetime.fromisoformat(end_date) - datetime.fromisoformat(start_date)
+        bulk = not incremental and tracked and span.days > BULK_LOAD_DAYS
+        if bulk:
+            with get_session() as session:
+                bulk = price_history_is_empty(session)
+    if bulk:
+        logger.info("Bulk load: rebuilding price_history indexes after ingestion")
+    else:
+        restored = restore_price_indexes()
+        if restored:
+            logger.warning(f"Recreated price_history indexes left dropped by an earlier bulk load: {restored}")
+
+    # IDX stocks (prices + info + statements) and global assets (prices only) share
+    # nothing, so the global group runs in the background on its own session while
+    # the IDX group runs here, where Ctrl-C is delivered. Both draw on one FetchPool,
+    # so --workers and --delay bound the whole run, and stopping it stops both.
+    groups = defaultdict(list)
+    for s in symbols:
+        groups["idx" if s.endswith(".JK") else "global"].append(s)
+    idx_symbols, global_symbols = groups["idx"], groups["global"]
+
+    with deferred_price_indexes() if bulk else nullcontext():
+        with FetchPool(workers, delay) as pool, ThreadPoolExecutor(max_workers=1) as executor:
+            background = None
+            try:
+                if global_symbols:
+                    background = executor.submit(ingest_group, global_symbols, start_date, end_date,
+                                                 pool, incremental)
+                ok = True
+                if idx_symbols:
+                    ok = ingest_group(idx_symbols, start_date, end_date, pool, incremental)
+
+                if background is not None:
+                    try:
+                        ok = background.result() and ok
+                    except Exception as e:
+                        logger.error(f"Global assets ingestion failed: {e}")
+                        ok = False
+            except KeyboardInterrupt:
+                # The background group stops at its next symbol; leaving the executor
+                # waits for it so its session closes before indexes are rebuilt.
+                pool.stop.set()
+                logger.warning("Interrupted, stopping...")
+                ok = False
+        return ok
+
+
+def ingest_group(symbols: list[str], start_date: str, end_date: str, pool: FetchPool,
+                 incremental: bool = False) -> bool:
+    # One session per group, committed every COMMIT_EVERY symbols and when it closes
+    with get_session() as session:
+        assets = get_assets(session)
+
+        # Incremental runs resume each asset from its latest stored bar (refetched,
+        # since it may have been captured intraday) instead of the full range.
+        starts = dict.fromkeys(symbols, start_date)
+        if incremental:
+            latest = get_latest_price_dates(session)
+            for s in symbols:
+                asset = assets.get(s.removesuffix(".JK").upper())
+                last = latest.get(asset.id) if asset else None
+                if last is not None:
+                    starts[s] = max(start_date, last.isoformat())
+
+            skipped = [s for s in symbols if starts[s] >= end_date]
+            if skipped:
+                logger.info(f"Up to date, skipped: {skipped}")
+            symbols = [s for s in symbols if starts[s] < end_date]
+            if not symbols:
+                return True
+
+        prices = download_prices(symbols, min(starts.values()), end_date)
+        prices = {s: df.loc[starts[s]:] for s, df in prices.items()}
+
+        # Global assets' metadata is known up front, so those the bulk download returned
+        # data for are created in one batch. Symbols without data (typos, delisted, Yahoo
+        # down) are never created here; IDX names come from ticker.info, and both fall
+        # back to get_or_create_asset once history has actually been fetched.
+        create_assets(session, [
+            {"symbol": s.upper(), "name": s, "asset_type": "unknown", "currency": "USD", "yahoo_symbol": s}
+            for s, df in prices.items() if not s.endswith(".JK") and not df.empty
+        ], assets)
+
+        # Fundamentals snapshots are queued and written per checkpoint: one execute_batch
+        # round trip for up to COMMIT_EVERY symbols instead of one INSERT each
+        stored, fundamentals = 0, []
+
+        def checkpoint():
+            if fundamentals:
+                store_fundamentals(session, fundamentals)
+                fundamentals.clear()
+            session.commit()
+
+        def store(symbol, data):
+            nonlocal stored
+            rows = store_asset(session, symbol, data, assets, fundamentals)
+            stored += 1
+            if stored % COMMIT_EVERY == 0:
+                checkpoint()
+            return rows
+
+        ok = run_loop(
+            symbols,
+            lambda s: fetch_asset(s, starts[s], end_date, prices.get(s)),
+            store,
+            pool,
+        )
+        checkpoint()
+        return ok
 
 
 def main():
@@ -184,9 +455,15 @@ def main():
     parser.add_argument("--start", type=str, help="Start date (YYYY-MM-DD)")
     parser.add_argument("--end", type=str, help="End date (YYYY-MM-DD)")
     parser.add_argument("--days", type=int, help="Override years with number of days")
-    parser.add_argument("--delay", type=float, default=0.5, help="Delay between requests")
+    parser.add_argument("--delay", type=float, default=0.5, help="Delay between requests (per worker)")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent Yahoo Finance fetches")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only fetch prices newer than what is stored (implied by --days)")
+    parser.add_argument("--bulk", action="store_true", default=None,
+                        help="Rebuild price_history indexes after loading (default: first full load only)")
 
     args = parser.parse_args()
+    configure_logging()
 
     end = args.end or datetime.now().strftime("%Y-%m-%d")
     if args.days:
@@ -195,8 +472,9 @@ def main():
         start = args.start or (datetime.now() - timedelta(days=args.years * 365)).strftime("%Y-%m-%d")
 
     symbols = [s.upper() for s in args.symbols] if args.symbols else None
-    run_all(start, end, symbols, args.delay)
-    print("\nDone.")
+    incremental = args.incremental or bool(args.days)
+    run_all(start, end, symbols, args.delay, args.workers, incremental, args.bulk)
+    logger.info("\nDone.")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,21 @@
 """Shared utilities for ingestion scripts."""
 
+import logging
+import logging.handlers
 import math
+import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Callable, Optional
+from typing import Any, Callable, Optional
 
 import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
 
-from ingestion.db import get_session, upsert_price, upsert_financials
+from ingestion.db import get_session, upsert_prices, upsert_prices_staged, upsert_financials
+
+logger = logging.getLogger(__name__)
 
 
 def safe_float(val) -> Optional[float]:
@@ -18,63 +26,178 @@ def safe_float(val) -> Optional[float]:
         return None
 
 
+def chunks(seq, size: int = 500):
+    """Yield consecutive slices of seq with at most size items each."""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
 def store_prices(session, asset_id: int, df, precision: int = 4) -> int:
+    # Bars without an open or close are unusable; drop them up front rather than store half a bar
+    df = df.dropna(subset=["Open", "Close"])
+    frame = df[["Open", "High", "Low", "Close"]].round(precision)
+    frame.columns = ["open", "high", "low", "close"]
+    # Local calendar date of each bar, kept as datetime64 so it never round-trips through Python objects
+    frame.insert(0, "date", df.index.tz_localize(None).normalize())
+    frame.insert(0, "asset_id", asset_id)
+    # Nullable Int64 keeps missing volume as NULL; round() first so non-integral values can't break the cast
+    frame["volume"] = df["Volume"].round().astype("Int64")
+    # One row per (asset_id, date) conflict key: bars at different times on the same local
+    # date would make the staged ON CONFLICT merge fail with "cannot affect row a second time"
+    frame = frame.drop_duplicates(subset="date", keep="last").reset_index(drop=True)
+
+    try:
+        with session.begin_nested():
+            upsert_prices_staged(session, frame)
+        return len(frame)
+    except SQLAlchemyError as e:
+        logger.warning(f"    Bulk insert failed ({e.__class__.__name__}), retrying in batches")
+
+    # Retry in bounded batches; only a batch that fails again is split into
+    # per-row savepoints, so one bad bar doesn't abort the rest
     count = 0
-    for dt, row in df.iterrows():
-        upsert_price(
-            session, asset_id, dt.date(),
-            float(round(row["Open"], precision)) if pd.notna(row["Open"]) else None,
-            float(round(row["High"], precision)) if pd.notna(row["High"]) else None,
-            float(round(row["Low"], precision)) if pd.notna(row["Low"]) else None,
-            float(round(row["Close"], precision)) if pd.notna(row["Close"]) else None,
-            int(row["Volume"]) if pd.notna(row["Volume"]) else None,
-        )
-        count += 1
+    rows = frame.astype(object).where(frame.notna(), None).to_dict("records")
+    for batch in chunks(rows):
+        try:
+            with session.begin_nested():
+                upsert_prices(session, batch)
+            count += len(batch)
+            continue
+        except SQLAlchemyError:
+            pass
+
+        for params in batch:
+            try:
+                with session.begin_nested():
+                    upsert_prices(session, [params])
+                count += 1
+            except SQLAlchemyError as e:
+                logger.warning(f"    Skipped {params['date']:%Y-%m-%d}: {e}")
     return count
 
 
 def store_financial_df(session, asset_id: int, df, period_type: str, table: str, mapping: dict):
     if df is None or df.empty:
         return
-    for date_col in df.columns:
-        data = {}
-        for db_col, yf_keys in mapping.items():
-            for key in yf_keys:
-                if key in df.index:
-                    val = safe_float(df.loc[key, date_col])
-                    if val is not None:
-                        data[db_col] = val
-                        break
-        if data:
-            upsert_financials(session, table, asset_id, date_col.date(), period_type, data)
-
-
-def run_loop(symbols: list[str], fetch_fn: Callable[[str], int], delay: float = 0.5) -> bool:
-    """Iterate symbols, call fetch_fn(symbol), track progress and sleep between calls."""
+    values = df.apply(pd.to_numeric, errors="coerce")
+    values = values[~values.index.duplicated()]
+    # One row per statement date; each column takes the first alias with a value on that date
+    resolved = pd.DataFrame({
+        db_col: values.reindex(yf_keys).bfill().iloc[0]
+        for db_col, yf_keys in mapping.items()
+    }).dropna(how="all")
+    fields = list(mapping)
+    # NaN -> None in a single pass while converting to Python floats
+    cells = resolved.to_numpy(dtype=object, na_value=None).tolist()
+    rows = [
+        {"asset_id": asset_id, "d": date_col.date(), "pt": period_type, **dict(zip(fields, row))}
+        for date_col, row in zip(resolved.index, cells)
+    ]
+    upsert_financials(session, table, fields, rows)
+
+
+class RateLimiter:
+    """Space calls at least `interval` seconds apart across all threads."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class FetchPool:
+    """Fetch threads, rate limit and stop flag shared by every run_loop of one run.
+
+    workers threads in total, with request starts spaced delay/workers seconds apart, so
+    each worker averages one request per delay however many groups share the pool.
+    Once stop is set, queued fetches return None without touching the network.
+    """
+
+    def __init__(self, workers: int = 8, delay: float = 0.5):
+        workers = max(workers, 1)
+        self.stop = threading.Event()
+        self._limiter = RateLimiter(delay / workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, fn: Callable[[str], Any], symbol: str) -> Future:
+        def fetch():
+            if self.stop.is_set():
+                return None
+            self._limiter.wait()
+            return None if self.stop.is_set() else fn(symbol)
+
+        return self._executor.submit(fetch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def run_loop(symbols: list[str], fetch_fn: Callable[[str], Any], store_fn: Callable[[str, Any], int],
+             pool: FetchPool) -> bool:
+    """Run fetch_fn(symbol) on the pool and feed results, in order, to store_fn(symbol, data).
+
+    fetch_fn must only do network I/O; store_fn runs on the calling thread since
+    the DB session is not thread-safe. Returns False once the pool is stopped, which
+    Ctrl-C on this thread does for every loop sharing it.
+    """
+    futures = [pool.submit(fetch_fn, symbol) for symbol in symbols]
     total, ok, fail = 0, 0, []
-    for i, symbol in enumerate(symbols, 1):
-        print(f"\n[{i}/{len(symbols)}] {symbol}...")
-        try:
-            rows = fetch_fn(symbol)
-            total += rows
-            if rows > 0:
-                ok += 1
-            else:
+    try:
+        for i, (symbol, future) in enumerate(zip(symbols, futures), 1):
+            if pool.stop.is_set():
+                break
+            logger.info(f"\n[{i}/{len(symbols)}] {symbol}...")
+            try:
+                data = future.result()
+                if pool.stop.is_set():
+                    break
+                rows = store_fn(symbol, data)
+                total += rows
+                if rows > 0:
+                    ok += 1
+                else:
+                    fail.append(symbol)
+            except Exception as e:
+                logger.error(f"    Error: {e}")
                 fail.append(symbol)
-        except KeyboardInterrupt:
-            return False
-        except Exception as e:
-            print(f"    Error: {e}")
-            fail.append(symbol)
-        if i < len(symbols):
-            time.sleep(delay)
-
-    print(f"\nDone. Success={ok}, Failed={len(fail)}, Rows={total}")
+    except KeyboardInterrupt:
+        pool.stop.set()
+
+    if pool.stop.is_set():
+        for future in futures:
+            future.cancel()
+        logger.warning(f"\nInterrupted. Success={ok}, Failed={len(fail)}, Rows={total}")
+        return False
+
+    logger.info(f"\nDone. Success={ok}, Failed={len(fail)}, Rows={total}")
     if fail:
-        print("Failed:", fail)
+        logger.warning(f"Failed: {fail}")
     return True
 
 
+def configure_logging(level: int = logging.INFO):
+    """Send ingestion logs to stdout; when not on a TTY (cron, Docker), buffer them.
+
+    Buffered records are written in blocks of 256, or immediately once an error is logged.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if not sys.stdout.isatty():
+        handler = logging.handlers.MemoryHandler(capacity=256, flushLevel=logging.ERROR, target=handler)
+    logging.basicConfig(level=level, format="%(message)s", handlers=[handler])
+
+
 def parse_date_range(args, default_years: int = 10) -> tuple[str, str]:
     """Resolve start/end date strings from parsed argparse args."""
     end_date = args.end or datetime.now().strftime("%Y-%m-%d")